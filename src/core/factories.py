@@ -1,3 +1,4 @@
+import math
 from functools import wraps
 from inspect import isfunction, isgeneratorfunction, getmembers
 from collections.abc import Iterable
@@ -133,24 +134,52 @@ def single_model_factory(model_name, C):
 def single_optim_factory(optim_name, params, C):
     optim_name = optim_name.strip()
     name = optim_name.upper()
+    # Update all params with a single fused kernel on CUDA devices, or
+    # with the multi-tensor (foreach) implementation elsewhere
+    impl = dict(fused=True) if torch.device(C.device).type == 'cuda' else dict(foreach=True)
     if name == 'ADAM':
         return torch.optim.Adam(
             params, 
             betas=(0.9, 0.999),
             lr=C.lr,
-            weight_decay=C.weight_decay
+            weight_decay=C.weight_decay,
+            **impl
         )
     elif name == 'SGD':
         return torch.optim.SGD(
             params, 
             lr=C.lr,
             momentum=0.9,
-            weight_decay=C.weight_decay
+            weight_decay=C.weight_decay,
+            **impl
         )
     else:
         raise NotImplementedError("{} is not a supported optimizer type".format(optim_name))
 
 
+def sched_factory(sched_name, optimizer, C):
+    # All schedules are in closed form of the epoch, which makes resuming trivial
+    name = sched_name.strip().upper()
+    if name == 'STEP':
+        lr_lambda = lambda e: 0.5 ** (e // C.step)
+    elif name == 'POLY':
+        lr_lambda = lambda e: (1 - e / C.num_epochs) ** 1.1
+    elif name == 'CONST':
+        lr_lambda = lambda e: 1.0
+    elif name == 'COSINE_WARMUP':
+        warmup = C.warmup_epochs
+        def lr_lambda(e):
+            if e < warmup:
+                # Linear warmup
+                return (e+1) / warmup
+            else:
+                # Cosine annealing
+                return 0.5 * (1 + math.cos(math.pi * (e-warmup) / max(C.num_epochs-warmup, 1)))
+    else:
+        raise NotImplementedError("{} is not a supported lr mode".format(sched_name))
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda)
+
+
 def single_critn_factory(critn_name, C):
     import losses
     critn_name = critn_name.strip()
@@ -183,6 +212,18 @@ def _get_basic_configs(ds_name, C):
         return dict()
         
 
+def _get_worker_configs(num_workers):
+    if num_workers > 0:
+        # Keep the workers alive across epochs to avoid respawning them
+        return dict(
+            num_workers=num_workers,
+            persistent_workers=True,
+            prefetch_factor=4
+        )
+    else:
+        return dict(num_workers=0)
+
+
 def single_train_ds_factory(ds_name, C):
     ds_name = ds_name.strip()
     module = _import_module('data', ds_name)
@@ -207,13 +248,17 @@ def single_train_ds_factory(ds_name, C):
         pass
     
     dataset_obj = dataset(**configs)
+
+    # Each process draws a disjoint shard in distributed training
+    sampler = data.DistributedSampler(dataset_obj, shuffle=True) if C.distributed else None
     
     return data.DataLoader(
         dataset_obj,
         batch_size=C.batch_size,
-        shuffle=True,
-        num_workers=C.num_workers,
-        pin_memory=not (C.device == 'cpu'), drop_last=True
+        shuffle=(sampler is None),
+        sampler=sampler,
+        pin_memory=not (C.device == 'cpu'), drop_last=True,
+        **_get_worker_configs(C.num_workers)
     )
 
 
@@ -247,8 +292,8 @@ def single_val_ds_factory(ds_name, C):
         dataset_obj,
         batch_size=1,
         shuffle=False,
-        num_workers=1,
-        pin_memory=False, drop_last=False
+        pin_memory=not (C.device == 'cpu'), drop_last=False,
+        **_get_worker_configs(min(C.num_workers, 1))
     )
 
 
@@ -1,27 +1,97 @@
 import shutil
 import os
+import pickle
+import zipfile
+import json
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait
 from types import MappingProxyType
-from copy import deepcopy
+from copy import copy
+from contextlib import nullcontext
 
+import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from skimage import io
 from tqdm import tqdm
 
 import constants
 from data.common import to_array
 from utils.misc import R
-from utils.metrics import AverageMeter
+from utils.metrics import AverageMeter, update_metrics
 from utils.utils import mod_crop
-from .factories import (model_factory, optim_factory, critn_factory, data_factory, metric_factory)
+from .factories import (model_factory, optim_factory, sched_factory, critn_factory, data_factory, metric_factory)
+
+
+def _get_safe_globals():
+    # Old checkpoints store max_acc as a numpy scalar
+    # Note that the (obj, name) form requires torch>=2.6
+    try:
+        from numpy._core.multiarray import scalar
+    except ImportError:
+        from numpy.core.multiarray import scalar
+    dtypes = [type(np.dtype(t)) for t in (np.float64, np.float32)]
+    return [
+        (scalar, 'numpy.core.multiarray.scalar'), 
+        (scalar, 'numpy._core.multiarray.scalar'),
+        np.dtype, *dtypes
+    ]
+
+
+def _write_atomic(data, path):
+    # An interrupted write never leaves a corrupt file behind
+    tmp_path = path + '.tmp'
+    # A leftover tmp file might be a hard link to another checkpoint,
+    # so never write through it
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    with open(tmp_path, 'xb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _link_atomic(src, dst):
+    # Hard-link dst to src, which costs no extra write
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        # Hard links are not supported everywhere
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def _write_checkpoint(buf, latest_path, history_path=None, best_path=None):
+    # Write the payload only once and link the other files to it
+    # Every write creates a new file, so the links are never modified afterwards
+    paths = [p for p in (history_path, best_path) if p is not None]
+    paths.append(latest_path)
+    _write_atomic(buf.getbuffer(), paths[0])
+    for path in paths[1:]:
+        _link_atomic(paths[0], path)
 
 
 class Trainer:
     def __init__(self, model, dataset, criterion, optimizer, settings):
         super().__init__()
-        context = deepcopy(settings)
+        # The settings are only read, so a shallow copy suffices
+        context = copy(settings)
         self.ctx = MappingProxyType(vars(context))
         self.mode = ('train', 'val').index(context.cmd)
 
+        # The process group is set up before the trainer is built
+        self.distributed = context.distributed and self.is_training
+        if self.distributed:
+            self.rank = dist.get_rank()
+            self.local_rank = torch.device(context.device).index
+        else:
+            self.rank = 0
+
         self.logger = R['LOGGER']
         self.gpc = R['GPC']     # Global Path Controller
         self.path = self.gpc.get_path
@@ -34,32 +104,68 @@ class Trainer:
         self.save = context.save_on or context.out_dir
         self.out_dir = context.out_dir
         self.trace_freq = int(context.trace_freq)
+        self.log_freq = int(context.log_freq)
+        self.accum_steps = int(context.accum_steps)
         self.device = torch.device(context.device)
         self.suffix_off = context.suffix_off
+        # Mixed precision is only enabled on CUDA devices
+        self.amp = context.amp and self.device.type == 'cuda'
+        # Prefer BF16 where supported, otherwise fall back to FP16
+        self.amp_dtype = torch.float16 if self.amp and not torch.cuda.is_bf16_supported() else torch.bfloat16
 
-        for k, v in sorted(self.ctx.items()):
-            self.logger.show("{}: {}".format(k,v))
+        self.logger.show(json.dumps(dict(self.ctx), indent=2, sort_keys=True, default=str))
 
         self.model = model_factory(model, context)
         self.model.to(self.device)
+        # NHWC lets cuDNN pick the tensor-core conv kernels
+        self.model.to(memory_format=torch.channels_last)
+        # Keep a handle to the bare model for state dicts and optimizers
+        self._module = self.model
+        if self.distributed:
+            self.model = DistributedDataParallel(
+                self.model, device_ids=[self.local_rank], 
+                gradient_as_bucket_view=True, bucket_cap_mb=25
+            )
+        if context.compile and self.is_training:
+            # Training patches have a fixed size, so specialize the graph for it
+            self.model = torch.compile(self.model, mode='max-autotune', dynamic=False)
         self.criterion = critn_factory(criterion, context)
         self.criterion.to(self.device)
         self.metrics = metric_factory(context.metrics, context)
+        self._metric_resets = tuple(m.reset for m in self.metrics)
 
         if self.is_training:
             self.train_loader = data_factory(dataset, 'train', context)
             self.val_loader = data_factory(dataset, 'val', context)
-            self.optimizer = optim_factory(optimizer, self.model, context)
+            self.optimizer = optim_factory(optimizer, self._module, context)
+            self.scheduler = sched_factory(context.lr_mode, self.optimizer, context)
+            # Only FP16 needs loss scaling
+            # A disabled scaler simply passes the loss and the step through
+            self.scaler = torch.amp.GradScaler(
+                self.device.type, 
+                enabled=self.amp and self.amp_dtype == torch.float16
+            )
         else:
             self.val_loader = data_factory(dataset, 'val', context)
         
         self.start_epoch = 0
         self._init_max_acc_and_epoch = (0.0, 0)
 
+        # Checkpoints are written to disk in the background
+        self._ckpt_executor = ThreadPoolExecutor(max_workers=1)
+        self._ckpt_future = None
+        # So are the output images
+        self._io_executor = ThreadPoolExecutor(max_workers=4)
+        self._io_futures = []
+
     @property
     def is_training(self):
         return self.mode == 0
 
+    @property
+    def is_main(self):
+        return self.rank == 0
+
     def train_epoch(self, epoch):
         raise NotImplementedError
 
@@ -71,7 +177,10 @@ class Trainer:
 
     def run(self):
         if self.is_training:
-            self._write_prompt()
+            # Waiting for input would leave the other processes hanging
+            # in collectives until they time out
+            if not self.distributed:
+                self._write_prompt()
             self.train()
         else:
             self.evaluate()
@@ -82,8 +191,20 @@ class Trainer:
 
         max_acc, best_epoch = self._init_max_acc_and_epoch
 
+        # Catch up with the resumed epoch
+        while self.scheduler.last_epoch < self.start_epoch:
+            self.scheduler.step()
+
+        try:
+            self._train_epochs(max_acc, best_epoch)
+            self._wait_for_checkpoint()
+        finally:
+            self._ckpt_executor.shutdown(wait=True)
+            self._io_executor.shutdown(wait=True)
+
+    def _train_epochs(self, max_acc, best_epoch):
         for epoch in range(self.start_epoch, self.num_epochs):
-            lr = self._adjust_learning_rate(epoch)
+            lr = self.scheduler.get_last_lr()[0]
 
             self.logger.show_nl("Epoch: [{0}]\tlr {1:.06f}".format(epoch, lr))
 
@@ -91,12 +212,12 @@ class Trainer:
             self.train_epoch(epoch)
             
             # Clear the history of metric objects
-            for m in self.metrics:
-                m.reset()
+            for reset in self._metric_resets:
+                reset()
                 
             # Evaluate the model on validation set
             self.logger.show_nl("Validate")
-            acc = self.validate_epoch(epoch=epoch, store=self.save)
+            acc = self.validate_epoch(epoch=epoch, store=self.save and self.is_main)
             
             is_best = acc > max_acc
             if is_best:
@@ -105,46 +226,64 @@ class Trainer:
             self.logger.show_nl("Current: {:.6f} ({:03d})\tBest: {:.6f} ({:03d})\t".format(
                                 acc, epoch, max_acc, best_epoch))
 
+            # Update the learning rate for next epoch
+            self.scheduler.step()
+
             # The checkpoint saves next epoch
-            self._save_checkpoint(self.model.state_dict(), self.optimizer.state_dict(), (max_acc, best_epoch), epoch+1, is_best)
+            if self.is_main:
+                self._save_checkpoint(
+                    self._module.state_dict(), self.optimizer.state_dict(), 
+                    self.scheduler.state_dict(), self.scaler.state_dict(),
+                    (max_acc, best_epoch), epoch+1, is_best
+                )
         
     def evaluate(self):
-        if self.checkpoint: 
-            if self._resume_from_checkpoint():
-                self.validate_epoch(self.ckp_epoch, self.save)
-        else:
-            self.logger.warning("Warning: no checkpoint assigned!")
-
-    def _adjust_learning_rate(self, epoch):
-        if self.ctx['lr_mode'] == 'step':
-            lr = self.lr * (0.5 ** (epoch // self.ctx['step']))
-        elif self.ctx['lr_mode'] == 'poly':
-            lr = self.lr * (1 - epoch / self.num_epochs) ** 1.1
-        elif self.ctx['lr_mode'] == 'const':
-            lr = self.lr
-        else:
-            raise ValueError('unknown lr mode {}'.format(self.ctx['lr_mode']))
-
-        for param_group in self.optimizer.param_groups:
-            param_group['lr'] = lr
-        return lr
+        try:
+            if self.checkpoint: 
+                if self._resume_from_checkpoint():
+                    self.validate_epoch(self.ckp_epoch, self.save)
+            else:
+                self.logger.warning("Warning: no checkpoint assigned!")
+        finally:
+            self._ckpt_executor.shutdown(wait=True)
+            self._io_executor.shutdown(wait=True)
 
     def _resume_from_checkpoint(self):
-        ## XXX: This could be slow!
         if not os.path.isfile(self.checkpoint):
             self.logger.error("=> No checkpoint was found at '{}'.".format(self.checkpoint))
             return False
 
         self.logger.show("=> Loading checkpoint '{}'".format(
                         self.checkpoint))
-        checkpoint = torch.load(self.checkpoint, map_location=self.device)
+        # Map the file instead of reading it all into memory
+        # Legacy (non-zip) checkpoints, e.g. those saved by torch<1.6, cannot be mapped
+        mmap = zipfile.is_zipfile(self.checkpoint)
+        try:
+            with torch.serialization.safe_globals(_get_safe_globals()):
+                checkpoint = torch.load(self.checkpoint, map_location='cpu', mmap=mmap, weights_only=True)
+        except pickle.UnpicklingError as e:
+            if not self.ctx['unsafe_load']:
+                self.logger.error(
+                    "=> '{}' cannot be loaded with weights_only=True ({}). "
+                    "Use --unsafe-load to unpickle it fully if the file is trusted.".format(self.checkpoint, e)
+                )
+                return False
+            self.logger.warning(
+                "Warning: fully unpickling '{}', which can run arbitrary code.".format(self.checkpoint)
+            )
+            checkpoint = torch.load(self.checkpoint, map_location='cpu', mmap=mmap, weights_only=False)
 
-        state_dict = self.model.state_dict()
+        state_dict = self._module.state_dict()
         ckp_dict = checkpoint.get('state_dict', checkpoint)
-        update_dict = {k:v for k,v in ckp_dict.items() 
-            if k in state_dict and state_dict[k].shape == v.shape}
+        # Copy the matched params right into the storages of the model
+        num_to_update = 0
+        for k, v in ckp_dict.items():
+            t = state_dict.get(k)
+            if t is None or t.shape != v.shape:
+                continue
+            t.copy_(v)
+            num_to_update += 1
         
-        num_to_update = len(update_dict)
         if (num_to_update < len(state_dict)) or (len(state_dict) < len(ckp_dict)):
             if not self.is_training and (num_to_update < len(state_dict)):
                 self.logger.error("=> Mismatched checkpoint for evaluation")
@@ -169,39 +308,59 @@ class Trainer:
                     self.optimizer.load_state_dict(checkpoint['optimizer'])
                 except KeyError:
                     self.logger.warning("Warning: failed to load optimizer parameters.")
-
-        state_dict.update(update_dict)
-        self.model.load_state_dict(state_dict)
+                if 'scheduler' in checkpoint:
+                    self.scheduler.load_state_dict(checkpoint['scheduler'])
+                # The state is empty if the scaler was disabled when saving
+                if checkpoint.get('scaler'):
+                    self.scaler.load_state_dict(checkpoint['scaler'])
 
         self.logger.show("=> Loaded checkpoint '{}' (epoch {}, max_acc {:.4f} at epoch {})".format(
             self.checkpoint, self.ckp_epoch, *self._init_max_acc_and_epoch
             ))
         return True
         
-    def _save_checkpoint(self, state_dict, optim_state, max_acc, epoch, is_best):
+    def _save_checkpoint(self, state_dict, optim_state, sched_state, scaler_state, max_acc, epoch, is_best):
         state = {
             'epoch': epoch,
             'state_dict': state_dict,
             'optimizer': optim_state, 
+            'scheduler': sched_state,
+            'scaler': scaler_state,
             'max_acc': max_acc
         } 
+        # Serialize on the main thread to take a consistent snapshot
+        buf = BytesIO()
+        torch.save(state, buf)
+
         # Save history
-        history_path = self.path('weight', constants.CKP_COUNTED.format(e=epoch), underline=True)
         if epoch % self.trace_freq == 0:
-            torch.save(state, history_path)
+            history_path = self.path('weight', constants.CKP_COUNTED.format(e=epoch), underline=True)
+        else:
+            history_path = None
         # Save latest
         latest_path = self.path(
             'weight', constants.CKP_LATEST, 
             underline=True
         )
-        torch.save(state, latest_path)
         if is_best:
-            shutil.copyfile(
-                latest_path, self.path(
-                    'weight', constants.CKP_BEST, 
-                    underline=True
-                )
+            best_path = self.path(
+                'weight', constants.CKP_BEST, 
+                underline=True
             )
+        else:
+            best_path = None
+
+        # Only one write job is in flight at a time
+        self._wait_for_checkpoint()
+        self._ckpt_future = self._ckpt_executor.submit(
+            _write_checkpoint, buf, latest_path, history_path, best_path
+        )
+
+    def _wait_for_checkpoint(self):
+        if self._ckpt_future is not None:
+            # Re-raise any exception from the writer thread
+            self._ckpt_future.result()
+            self._ckpt_future = None
     
     @property
     def ckp_epoch(self):
@@ -221,7 +380,58 @@ class Trainer:
             auto_make=True,
             underline=True
         )
-        return io.imsave(out_path, image)
+        if out_path.lower().endswith('.png'):
+            # zlib compression dominates the encoding time
+            kwargs = dict(compress_level=1)
+        else:
+            kwargs = dict()
+        future = self._io_executor.submit(io.imsave, out_path, image, **kwargs)
+        self._io_futures.append(future)
+        return future
+
+    def _wait_for_images(self):
+        done, _ = wait(self._io_futures)
+        self._io_futures = []
+        for future in done:
+            # Re-raise any exception from the writer threads
+            future.result()
+
+
+class CDPrefetcher:
+    def __init__(self, loader, device):
+        super().__init__()
+        self.loader = iter(loader)
+        self.device = device
+        # A side stream is only available (and useful) on CUDA devices
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.preload()
+
+    def _to_device(self, batch):
+        return tuple(x.to(self.device, non_blocking=True) for x in batch)
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        if self.stream is None:
+            self.batch = self._to_device(batch)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.batch = self._to_device(batch)
+
+    def next(self):
+        batch = self.batch
+        if self.stream is not None:
+            cur_stream = torch.cuda.current_stream(self.device)
+            cur_stream.wait_stream(self.stream)
+            if batch is not None:
+                # Keep the memory from being reused by the side stream too early
+                for x in batch:
+                    x.record_stream(cur_stream)
+        self.preload()
+        return batch
 
 
 class CDTrainer(Trainer):
@@ -231,72 +441,127 @@ class CDTrainer(Trainer):
     def train_epoch(self, epoch):
         losses = AverageMeter()
         len_train = len(self.train_loader)
-        pb = tqdm(self.train_loader)
+        pb = tqdm(total=len_train, disable=not self.is_main)
         
+        if self.distributed:
+            # Reshuffle the shards for each epoch
+            self.train_loader.sampler.set_epoch(epoch)
+
         self.model.train()
 
-        for i, (t1, t2, label) in enumerate(pb):
-            t1, t2, label = t1.to(self.device), t2.to(self.device), label.to(self.device)
-            
-            prob = self.model(t1, t2)
+        # Copy the next batch to device while the current one is being computed
+        prefetcher = CDPrefetcher(self.train_loader, self.device)
+        batch = prefetcher.next()
+        i = 0
+        while batch is not None:
+            t1, t2, label = batch
+            t1 = t1.contiguous(memory_format=torch.channels_last)
+            t2 = t2.contiguous(memory_format=torch.channels_last)
+
+            # Accumulate gradients over several batches before each step
+            do_step = (i+1) % self.accum_steps == 0 or (i+1) == len_train
+            # The last group of an epoch may hold fewer batches
+            accum_size = min(self.accum_steps, len_train - (i - i % self.accum_steps))
+            if self.distributed and not do_step:
+                # No need to all-reduce the gradients until the step
+                sync_ctx = self.model.no_sync()
+            else:
+                sync_ctx = nullcontext()
             
-            loss = self.criterion(prob, label)
+            with sync_ctx:
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp):
+                    prob = self.model(t1, t2)
+                    
+                    loss = self.criterion(prob, label)
+
+                # Compute gradients
+                self.scaler.scale(loss / accum_size).backward()
             
-            losses.update(loss.item(), n=self.batch_size)
+            # Accumulate on device to avoid a sync in every iteration
+            losses.update(loss.detach(), n=t1.size(0))
+
+            if do_step:
+                # Do SGD step
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
+
+            pb.update(1)
+            if (i+1) % self.log_freq == 0 or (i+1) == len_train:
+                # Formatting the meters reads their values back to host
+                desc = self.logger.make_desc(
+                    i+1, len_train,
+                    ('loss', losses, '.4f')
+                )
 
-            # Compute gradients and do SGD step
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+                pb.set_description(desc)
+                self.logger.dump(desc)
 
-            desc = self.logger.make_desc(
-                i+1, len_train,
-                ('loss', losses, '.4f')
-            )
+            i += 1
+            batch = prefetcher.next()
 
-            pb.set_description(desc)
-            self.logger.dump(desc)
+        pb.close()
 
     def validate_epoch(self, epoch=0, store=False):
         self.logger.show_nl("Epoch: [{0}]".format(epoch))
         losses = AverageMeter()
         len_val = len(self.val_loader)
-        pb = tqdm(self.val_loader)
+        pb = tqdm(self.val_loader, disable=not self.is_main)
 
         self.model.eval()
 
-        with torch.no_grad():
+        def _dump_desc(counter):
+            desc = self.logger.make_desc(
+                counter, len_val,
+                ('loss', losses, '.4f'),
+                *(
+                    (m.__name__, m, '.4f')
+                    for m in self.metrics
+                )
+            )
+            pb.set_description(desc)
+            self.logger.dump(desc)
+
+        num_done = num_logged = 0
+        with torch.inference_mode():
             for i, (name, t1, t2, label) in enumerate(pb):
                 if self.is_training and i >= 16: 
                     # Do not validate all images on training phase
                     pb.close()
                     self.logger.warning("validation ends early")
                     break
-                t1, t2, label = t1.to(self.device), t2.to(self.device), label.to(self.device)
-
-                prob = self.model(t1, t2)
-
-                loss = self.criterion(prob, label)
-                losses.update(loss.item(), n=self.batch_size)
-
-                # Convert to numpy arrays
-                CM = to_array(torch.argmax(prob[0], 0)).astype('uint8')
-                label = to_array(label[0]).astype('uint8')
-                for m in self.metrics:
-                    m.update(CM, label)
-
-                desc = self.logger.make_desc(
-                    i+1, len_val,
-                    ('loss', losses, '.4f'),
-                    *(
-                        (m.__name__, m, '.4f')
-                        for m in self.metrics
-                    )
-                )
-                pb.set_description(desc)
-                self.logger.dump(desc)
+                t1 = t1.to(self.device, non_blocking=True)
+                t2 = t2.to(self.device, non_blocking=True)
+                label = label.to(self.device, non_blocking=True)
+                t1 = t1.contiguous(memory_format=torch.channels_last)
+                t2 = t2.contiguous(memory_format=torch.channels_last)
+
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp):
+                    # Validation images vary in size, so bypass the compiled wrapper
+                    prob = self._module(t1, t2)
+
+                    loss = self.criterion(prob, label)
+                losses.update(loss.detach(), n=t1.size(0))
+
+                # The metrics are computed on device over the whole batch
+                pred = prob.argmax(dim=1)
+                update_metrics(self.metrics, pred, label)
+
+                num_done = i+1
+                if num_done % self.log_freq == 0:
+                    _dump_desc(num_done)
+                    num_logged = num_done
                     
                 if store:
+                    # Convert to numpy arrays only when writing files
+                    CM = to_array(pred[0]).astype('uint8')
                     self.save_image(name[0], CM*255, epoch)
 
-        return self.metrics[0].avg if len(self.metrics) > 0 else max(1.0 - losses.avg, self._init_max_acc)
\ No newline at end of file
+            if num_done > num_logged:
+                # Always record the final values, also when validation ends early
+                _dump_desc(num_done)
+
+        # Make sure all images are on disk before returning
+        self._wait_for_images()
+
+        return float(self.metrics[0].avg) if len(self.metrics) > 0 else max(1.0 - float(losses.avg), self._init_max_acc)
\ No newline at end of file
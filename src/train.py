@@ -4,9 +4,11 @@ import os
 import shutil
 import random
 import ast
+from datetime import timedelta
 from os.path import basename, exists, splitext
 
 import torch
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
 import numpy as np
 import yaml
@@ -42,7 +44,7 @@ def parse_args():
     group_data.add_argument('-d', '--dataset', type=str, default='OSCD')
     group_data.add_argument('-p', '--crop-size', type=int, default=256, metavar='P', 
                         help='patch size (default: %(default)s)')
-    group_data.add_argument('--num-workers', type=int, default=8)
+    group_data.add_argument('--num-workers', type=int, default=min(8, os.cpu_count() or 1))
     group_data.add_argument('--repeats', type=int, default=100)
 
     # Optimizer
@@ -54,20 +56,34 @@ def parse_args():
     group_optim.add_argument('--weight-decay', default=1e-4, type=float,
                         metavar='W', help='weight decay (default: %(default)s)')
     group_optim.add_argument('--step', type=int, default=200)
+    group_optim.add_argument('--warmup-epochs', type=int, default=5,
+                        help='number of warmup epochs in cosine_warmup mode (default: %(default)s)')
 
     # Training related
     group_train = parser.add_argument_group('training related')
     group_train.add_argument('--batch-size', type=int, default=8, metavar='B',
                         help='input batch size for training (default: %(default)s)')
+    group_train.add_argument('--accum-steps', type=int, default=1,
+                        help='number of batches to accumulate gradients over (default: %(default)s)')
     group_train.add_argument('--num-epochs', type=int, default=1000, metavar='NE',
                         help='number of epochs to train (default: %(default)s)')
     group_train.add_argument('--load-optim', action='store_true')
     group_train.add_argument('--resume', default='', type=str, metavar='PATH',
                         help='path to latest checkpoint')
+    group_train.add_argument('--unsafe-load', action='store_true',
+                        help='allow fully unpickling trusted checkpoints that fail the weights-only loader')
     group_train.add_argument('--anew', action='store_true',
                         help='clear history and start from epoch 0 with the checkpoint loaded')
     group_train.add_argument('--trace-freq', type=int, default=50)
+    group_train.add_argument('--log-freq', type=int, default=10,
+                        help='iterations between progress updates (default: %(default)s)')
     group_train.add_argument('--device', type=str, default='cpu')
+    group_train.add_argument('--amp', action='store_true',
+                        help='enable automatic mixed precision on CUDA devices')
+    group_train.add_argument('--distributed', action='store_true',
+                        help='use DistributedDataParallel (launch with torchrun)')
+    group_train.add_argument('--compile', action='store_true',
+                        help='compile the model with torch.compile for training')
     group_train.add_argument('--metrics', type=str, default='F1Score+Accuracy+Recall+Precision')
 
     # Experiment
@@ -109,17 +125,36 @@ def parse_args():
     return args
 
 
-def set_gpc_and_logger(args):
+def init_distributed(args):
+    # Expect to be launched by torchrun, which sets the env vars
+    dist.init_process_group('nccl', timeout=timedelta(minutes=30))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    args.device = 'cuda:{}'.format(local_rank)
+    torch.cuda.set_device(local_rank)
+    return dist.get_rank()
+
+
+def set_gpc_and_logger(args, is_main=True):
+    if not is_main:
+        # Let the main process create the directories first
+        dist.barrier()
+
     gpc = OutPathGetter(
             root=os.path.join(args.exp_dir, args.tag), 
             suffix=args.suffix)
 
-    log_dir = '' if args.log_off else gpc.get_dir('log')
-    logger = Logger(
-        scrn=True,
-        log_dir=log_dir,
-        phase=args.cmd
-    )
+    if is_main:
+        log_dir = '' if args.log_off else gpc.get_dir('log')
+        logger = Logger(
+            scrn=True,
+            log_dir=log_dir,
+            phase=args.cmd
+        )
+        if dist.is_initialized():
+            dist.barrier()
+    else:
+        # Other processes only report errors
+        logger = Logger(scrn=False, err_level='error')
 
     register('GPC', gpc)
     register('LOGGER', logger)
@@ -129,9 +164,14 @@ def set_gpc_and_logger(args):
 
 def main():
     args = parse_args()
-    gpc, logger = set_gpc_and_logger(args)
-
-    if args.exp_config:
+    if args.distributed and args.cmd == 'train':
+        rank = init_distributed(args)
+    else:
+        rank = 0
+    is_main = (rank == 0)
+    gpc, logger = set_gpc_and_logger(args, is_main)
+
+    if args.exp_config and is_main:
         # Make a copy of the config file
         cfg_path = gpc.get_path('root', basename(args.exp_config), suffix=False)
         shutil.copy(args.exp_config, cfg_path)
@@ -153,6 +193,9 @@ def main():
         # Catch ALL kinds of exceptions
         logger.fatal(traceback.format_exc())
         exit(1)
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
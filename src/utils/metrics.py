@@ -1,7 +1,4 @@
-from functools import partial
-
-import numpy as np
-from sklearn import metrics
+import torch
 
 
 class AverageMeter:
@@ -38,12 +35,28 @@ class AverageMeter:
         return 'val: {} avg: {} cnt: {}'.format(self.val, self.avg, self.count)
 
 
-# These metrics only for numpy arrays
+def confusion_matrix(true, pred, n_classes):
+    # Encode each (true, pred) pair as a single index and count them all at once
+    idx = true.reshape(-1).long()*n_classes + pred.reshape(-1).long()
+    return torch.bincount(idx, minlength=n_classes**2).view(n_classes, n_classes)
+
+
+def update_metrics(metrics, pred, true, n=1):
+    # Build the confusion matrix once and share it among the metrics
+    cms = {}
+    for m in metrics:
+        if m.n_classes not in cms:
+            cms[m.n_classes] = confusion_matrix(true, pred, m.n_classes)
+        m.update_cm(cms[m.n_classes], n=n)
+
+
+# These metrics only for tensors, which are kept on their own device
 class Metric(AverageMeter):
     __name__ = 'Metric'
     def __init__(self, n_classes=2, mode='accum', reduction='binary'):
         super().__init__(None)
-        self._cm = AverageMeter(partial(metrics.confusion_matrix, labels=np.arange(n_classes)))
+        self.n_classes = n_classes
+        self._cm = AverageMeter()
         assert mode in ('accum', 'separ')
         self.mode = mode
         assert reduction in ('mean', 'none', 'binary')
@@ -66,8 +79,11 @@ class Metric(AverageMeter):
             return self._compute(cm)[1]
 
     def update(self, pred, true, n=1):
+        self.update_cm(confusion_matrix(true, pred, self.n_classes), n=n)
+
+    def update_cm(self, cm, n=1):
         # Note that this is no thread-safe
-        self._cm.update(true.ravel(), pred.ravel())
+        self._cm.update(cm)
         if self.mode == 'accum':
             cm = self._cm.sum
         elif self.mode == 'separ':
@@ -83,13 +99,13 @@ class Metric(AverageMeter):
 class Precision(Metric):
     __name__ = 'Prec.'
     def _compute(self, cm):
-        return np.nan_to_num(np.diag(cm)/cm.sum(axis=0))
+        return torch.nan_to_num(cm.diag()/cm.sum(0))
 
 
 class Recall(Metric):
     __name__ = 'Recall'
     def _compute(self, cm):
-        return np.nan_to_num(np.diag(cm)/cm.sum(axis=1))
+        return torch.nan_to_num(cm.diag()/cm.sum(1))
 
 
 class Accuracy(Metric):
@@ -97,12 +113,12 @@ class Accuracy(Metric):
     def __init__(self, n_classes=2, mode='accum'):
         super().__init__(n_classes=n_classes, mode=mode, reduction='none')
     def _compute(self, cm):
-        return np.nan_to_num(np.diag(cm).sum()/cm.sum())
+        return torch.nan_to_num(cm.diag().sum()/cm.sum())
 
 
 class F1Score(Metric):
     __name__ = 'F1'
     def _compute(self, cm):
-        prec = np.nan_to_num(np.diag(cm)/cm.sum(axis=0))
-        recall = np.nan_to_num(np.diag(cm)/cm.sum(axis=1))
-        return np.nan_to_num(2*(prec*recall) / (prec+recall))
\ No newline at end of file
+        prec = torch.nan_to_num(cm.diag()/cm.sum(0))
+        recall = torch.nan_to_num(cm.diag()/cm.sum(1))
+        return torch.nan_to_num(2*(prec*recall) / (prec+recall))
\ No newline at end of file
@@ -19,14 +19,14 @@ class _LessThanFilter(logging.Filter):
 class Logger:
     _count = 0
 
-    def __init__(self, scrn=True, log_dir='', phase=''):
+    def __init__(self, scrn=True, log_dir='', phase='', err_level='warning'):
         super().__init__()
         self._logger = logging.getLogger('logger_{}'.format(Logger._count))
         Logger._count += 1
         self._logger.setLevel(logging.DEBUG)
 
         self._err_handler = logging.StreamHandler(stream=sys.stderr)
-        self._err_handler.setLevel(logging.WARNING)
+        self._err_handler.setLevel(getattr(logging, err_level.upper()))
         self._err_handler.setFormatter(logging.Formatter(fmt=FORMAT_SHORT))
         self._logger.addHandler(self._err_handler)
 